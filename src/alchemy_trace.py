@@ -27,6 +27,8 @@ class Tracer(object):
 		self.use_gzip = True
 		self.compress_level = 3
 		self.append_trace = True
+		self.compact_members = mtrace.DEFAULT_COMPACT_MEMBERS
+		self.sink = None
 		
 	def _check_datadir(self):
 		if not os.path.isdir(self.datadir):
@@ -68,14 +70,16 @@ class Tracer(object):
 			self.load_tables(force_fresh=force_fresh, skip_save=skip_save)
 		
 		ser_path = os.path.join(self.datadir, self.dbname + '_fields.ser')
-		if not force_fresh:
-			self.fields = _readobj(ser_path)
+		if not force_fresh and os.path.isfile(ser_path):
+			self.fields = mtrace.read_fields(ser_path)
 			if self.fields: return
 		
 		self.fields = get_trace_fields(self.meta)
 		
 		try:
-			if not skip_save: _writeobj(self.fields, ser_path)
+			if not skip_save:
+				self._check_datadir()
+				mtrace.write_fields(self.fields, ser_path)
 		except IOError, e:
 			print >>sys.stderr, "Failed to save field data, path=%s, err=%s" % (ser_path, e.strerror)
 
@@ -97,7 +101,12 @@ class Tracer(object):
 	def write_trace(self, tables=None):
 		"""Writes the current DB state as a Daikon trace file.
 		
+		If sink is set, the trace is streamed there instead.  A sink spec 
+		(see mysql_to_trace.open_sink) is opened for this call only, an 
+		open TraceSink is left open for more traces.
+		
 		@param tables: a sequence of table names to trace instead of all tables
+		@return: the TraceSink streamed to, if any, to check if the consumer kept up
 		"""
 		if not self.fields:
 			self.load_fields()
@@ -106,44 +115,31 @@ class Tracer(object):
 		if not isinstance(tables, (set, type(None))):
 			tables = set(tables)
 		
-		mode = 'a' if self.append_trace else 'w'
-		trace_path = os.path.join(self.datadir, self.dbname + '.dtrace')
-		if self.use_gzip:
-			mode += 'b'
-			trace_path += '.gz'
-			out = mtrace.GzipFile(trace_path, mode, self.compress_level)
-		else:
-			out = open(trace_path, mode)
-			
-		with out:
-			# build string pieces in a buffer to write once per db row
-			# saves a lot of time, especially with gzip on
-			buf = []
-			write = buf.append
-			def mwrite(*args): buf.extend(args)
-			
+		if self.sink is None:
+			trace_path = mtrace.trace_file_path(os.path.join(self.datadir, self.dbname + '.dtrace'), self.use_gzip)
+			self._write_trace(trace_path, tables)
+			if self.use_gzip and self.compact_members:
+				mtrace.compact_trace_if_needed(trace_path, self.compact_members, self.compress_level)
+			return None
+		if isinstance(self.sink, mtrace.TraceSink):
+			self._write_trace(self.sink, tables)
+			return self.sink
+		with mtrace.open_sink(self.sink, use_gzip=self.use_gzip, compress=self.compress_level) as sink:
+			self._write_trace(sink, tables)
+		return sink
+
+	def _write_trace(self, outpath, tables):
+		with mtrace.trace_output(outpath, use_gzip=self.use_gzip, compress=self.compress_level, append=self.append_trace) as out:
 			conn = self.engine.connect()
 			try:
 				for table, fields in self.fields.iteritems():
 					if tables and table not in tables: 
 						continue
 	
-					tbl_point = '\n%s:::POINT\n' % table
 					dbtable = self.meta.tables[table]
 					result = conn.execute(dbtable.select())
 					try:
-						for row in result:
-							write(tbl_point)
-							for i, field in enumerate(fields):
-								val = row[i]
-								if field.nullable:
-									write(field.null_trace_v1(val))
-									write('\n')
-								fval = str(field.to_val(val))
-								fmod = '1' if fval != 'nonsensical' else '2' 
-								mwrite(field.fullname(escaped=True), '\n', fval, '\n', fmod, '\n')
-							out.write(''.join(buf))
-							del buf[:]
+						mtrace.write_table_records(out, table, fields, result)
 					finally:
 						result.close()
 			finally:
@@ -195,8 +191,7 @@ def get_trace_fields(engine_or_meta=None, save_to=None):
 		]
 
 	if save_to is not None:
-		with open(save_to, mode='wb') as outfile:
-			pickle.dump(fields, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+		mtrace.write_fields(fields, save_to)
 	return fields
 
 def _readobj(path, alchemy=False):
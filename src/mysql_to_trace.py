@@ -6,12 +6,32 @@ import re
 import MySQLdb
 import getopt
 import gzip
+import contextlib
+import errno
+import os
+import socket
+import stat
+import struct
+import tempfile
+import time
+import zlib
 import cPickle as pickle
 from array import array
-from itertools import imap
+from itertools import imap, izip
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+try:
+	# same as SIOCOUTQ, bytes still queued on a socket
+	from termios import TIOCOUTQ as _SIOCOUTQ
+except ImportError:
+	_SIOCOUTQ = None
 
 _verbose = 0
 _DEFAULT_COMPRESS = 3
+# appending compacts a gzipped trace with more members than this, 0 disables
+DEFAULT_COMPACT_MEMBERS = 1000
 
 class GzipFile(gzip.GzipFile):
 	def __enter__(self):
@@ -23,7 +43,9 @@ class GzipFile(gzip.GzipFile):
 
 class Field(object):
 	"""Represents a database table field."""
-	def __init__(self, name, ftype, rtype=None, table=None, is_pkey=False, nullable=True):
+	__slots__ = ('table', 'name', 'ftype', 'rtype', 'tcode', 'to_val', 'cmp', 'nullable', 'is_pkey',
+		'_fullname', '_fullname_escaped', '_fullname_quoted', '_null_name')
+	def __init__(self, name, ftype, rtype=None, table=None, is_pkey=False, nullable=True, tcode=None):
 		self.table = table
 		self.name = name
 		if table:
@@ -37,7 +59,11 @@ class Field(object):
 		self.ftype = ftype
 		self.nullable = nullable
 		self.is_pkey = is_pkey
-		self.rtype, self.to_val, self.cmp = ftype_to_rep_val_comp(ftype)
+		# converters are bound by type code so they never need to be serialized
+		if tcode is None:
+			tcode = ftype_to_type_code(ftype)
+		self.tcode = tcode
+		self.rtype, self.to_val, self.cmp = _TYPE_REPS[tcode]
 		if rtype is not None: 
 			self.rtype = rtype
 		if is_pkey:
@@ -47,9 +73,15 @@ class Field(object):
 				self.nullable = False
 				if _verbose:
 					print >>sys.stderr, "Dropping nullable for PK:", self.fullname()
-		if self.nullable:
-			self.__nullable_name = self._fullname_escaped + '__IS_NULL__'
-			
+		self._null_name = self._fullname_escaped + '__IS_NULL__' if self.nullable else None
+
+	def __getstate__(self):
+		return (self.name, self.ftype, self.rtype, self.table, self.is_pkey, self.nullable, self.tcode)
+	def __setstate__(self, state):
+		if isinstance(state, dict):
+			# pickled by the old __dict__ based Field
+			state = (state['name'], state['ftype'], state['rtype'], state['table'], state['is_pkey'], state['nullable'])
+		self.__init__(*state)
 				
 	def fullname(self, quoted=False, escaped=False):
 		"""Returns the field name including the table, if known."""
@@ -71,7 +103,7 @@ class Field(object):
 		flags = 'non_null' if self.is_pkey else None
 		return var_decl_v2(fullname, self.rtype, dec_type=self.ftype.replace(' ', '_'), array=is_array, flags=flags, comp=self.cmp)
 	def _nullable_name(self, v1=False):
-		return self.__nullable_name
+		return self._null_name
 	def null_decl_v1(self):
 		if not self.nullable: raise RuntimeWarning, 'field is not nullable'
 		nname = self._nullable_name(v1=True)
@@ -85,7 +117,8 @@ class Field(object):
 		nname = self._nullable_name(v1=False)
 		return var_decl_v2(nname, 'hashcode', dec_type=nname, comp='8')
 	def __repr__(self):
-		return "Field(name=%(name)r, ftype=%(ftype)r, rtype=%(rtype)r, table=%(table)r, is_pkey=%(is_pkey)r, nullable=%(nullable)r)" % self.__dict__
+		return "Field(name=%r, ftype=%r, rtype=%r, table=%r, is_pkey=%r, nullable=%r)" % (
+			self.name, self.ftype, self.rtype, self.table, self.is_pkey, self.nullable)
 
 def var_decl_v2(variable, rep_type, dec_type='unspecified', var_kind='variable', flags=None, array=None, comp='1'):
 	data = ['  variable ' + variable, 'var-kind ' + var_kind, 'dec-type ' + dec_type, 'rep-type ' + rep_type]
@@ -101,9 +134,9 @@ def to_val(val):
 
 try:
 	from valconv import to_str_val
-	print "Using valconv.to_str_val..."
+	print >>sys.stderr, "Using valconv.to_str_val..."
 except:
-	print "Using Python version of to_str_val..."
+	print >>sys.stderr, "Using Python version of to_str_val..."
 	RE_STR_ESCAPE = re.compile(r'[\r\n\t\b"]')
 	_escapes = {'\r': '\\r', '\n': '\\n', '\t': '\\t', '\b': '\\b', '"': '\\"'}
 	def __str_escape(matcher, escapes=_escapes):
@@ -142,7 +175,75 @@ def to_set_val(val):
 	return '["%s"]' % '" "'.join( x.replace('"', '\\"') for x in val.split(',') )
 
 
-def convert(basename, decls_version=2, decls=True, dtrace=True, use_gzip=True, compress=_DEFAULT_COMPRESS, append=False, tables=None, **conn_args):
+# type codes, indexes into _TYPE_REPS of (rep-type, converter, comparability)
+TC_STR, TC_INT, TC_BIT, TC_DBL, TC_BIN, TC_SET, TC_TIME, TC_DATE = range(8)
+_TYPE_REPS = [
+	('java.lang.String', to_str_val, '1'),
+	('int', to_val, '2'),
+	('int', to_bit_val, '2'),
+	('double', to_val, '3'),
+	('int[]', to_bin_val, '4[2]'),
+	('java.lang.String[]', to_set_val, '5[1]'),
+	('java.lang.String', to_str_val, '6'),
+	('java.lang.String', to_str_val, '7'),
+]
+# codes past the built-in types depend on registration order, see register_type
+_BUILTIN_TYPE_CODES = len(_TYPE_REPS)
+# type codes are saved as unsigned bytes, see write_fields
+_MAX_TYPE_CODE = 255
+
+# normalized base type -> type code
+_BASE_TYPE_CODES = {}
+for _code, _names in (
+		(TC_STR, 'char varchar character enum text tinytext smalltext mediumtext bigtext longtext json'),
+		(TC_INT, 'int integer tinyint smallint mediumint bigint year bool boolean'),
+		(TC_BIT, 'bit'),
+		(TC_DBL, 'float double real decimal dec numeric fixed'),
+		(TC_BIN, 'blob tinyblob smallblob mediumblob bigblob longblob binary varbinary'),
+		(TC_SET, 'set'),
+		(TC_TIME, 'datetime timestamp'),
+		(TC_DATE, 'date')):
+	_BASE_TYPE_CODES.update(dict.fromkeys(_names.split(), _code))
+del _code, _names
+
+# memoized ftype -> type code
+_ftype_codes = {}
+
+def register_type(base_types, rtype, to_val, comp):
+	"""Registers the Daikon representation for one or more column types.
+	
+	Custom types must be registered before saved fields using them are 
+	read back. Their codes are re-derived from the column type on read,
+	so the registration order does not matter.
+	
+	@param base_types: a base type name like 'json' or a sequence of them
+	@param rtype: the Daikon rep-type, e.g. 'java.lang.String'
+	@param to_val: function converting a column value to its trace value
+	@param comp: the Daikon comparability string
+	@return: the type code assigned to the representation
+	@raise ValueError: if no more type codes are available
+	"""
+	if isinstance(base_types, basestring):
+		base_types = (base_types,)
+	tcode = len(_TYPE_REPS)
+	if tcode > _MAX_TYPE_CODE:
+		raise ValueError("Too many registered types, at most %d custom types are supported" % (
+			_MAX_TYPE_CODE + 1 - _BUILTIN_TYPE_CODES))
+	_TYPE_REPS.append((rtype, to_val, comp))
+	for base_type in base_types:
+		_BASE_TYPE_CODES[normalize_base_type(base_type)] = tcode
+	_ftype_codes.clear()
+	return tcode
+
+
+def convert(basename, decls_version=2, decls=True, dtrace=True, use_gzip=True, compress=_DEFAULT_COMPRESS, append=False, tables=None, compact_members=DEFAULT_COMPACT_MEMBERS, sink=None, **conn_args):
+	"""Writes Daikon declarations and/or a trace for a MySQL database.
+	
+	@param compact_members: compact an appended trace with more gzip members
+		than this, 0 or None to never compact
+	@param sink: optional sink spec (see open_sink) to stream the trace to
+		instead of writing it to the .dtrace file
+	"""
 	decls_path  = basename + '.decls'
 	fields_path = basename + '.fields'
 	dtrace_path = basename + '.dtrace'
@@ -165,9 +266,17 @@ def convert(basename, decls_version=2, decls=True, dtrace=True, use_gzip=True, c
 		if dtrace:
 			# write dtrace with fields either from above or previously serialized
 			if fields is None:
-				with open(fields_path, 'rb') as fieldsfile:
-					fields = pickle.load(fieldsfile)
+				fields = read_fields(fields_path)
+			if sink is not None:
+				with open_sink(sink, use_gzip=use_gzip, compress=compress) as out:
+					write_old_trace(conn, fields, out, tables=tables)
+				if _verbose or not out.kept_up:
+					print >>sys.stderr, out.summary()
+				return
 			write_old_trace(conn, fields, dtrace_path, use_gzip=use_gzip, compress=compress, append=append, tables=tables)
+			# merge the gzip members added by appending once there are too many
+			if append and use_gzip and compact_members:
+				compact_trace_if_needed(trace_file_path(dtrace_path), compact_members, compress)
 	finally:
 		if conn: conn.close()
 
@@ -180,38 +289,31 @@ def get_table_names(conn):
 	finally:
 		cur.close()
 
-_RE_STR = re.compile(r'enum|(var)?char|(big|small|medium)?text', re.IGNORECASE)
-_RE_INT = re.compile(r'(big|small|medium|tiny)?int(eger)?', re.IGNORECASE)
-_RE_BIT = re.compile(r'bit', re.IGNORECASE)
-_RE_DBL = re.compile(r'float|decimal|double', re.IGNORECASE)
-_RE_BIN = re.compile(r'(big|medium|small)?blob', re.IGNORECASE)
-_RE_SET = re.compile(r'set', re.IGNORECASE)
-_RE_TIME = re.compile(r'datetime|timestamp', re.IGNORECASE)
-_RE_DATE = re.compile(r'date', re.IGNORECASE)
-def ftype_to_rep_val_comp(ftype):
+def normalize_base_type(ftype):
+	"""Returns the lower-case base type without size or modifiers, 
+	e.g. 'int' for 'INT(10) UNSIGNED'."""
 	pindex = ftype.find('(')
 	base_type = ftype if pindex == -1 else ftype[:pindex]
-	
-	if _RE_STR.match(base_type):
-		return ('java.lang.String', to_str_val, '1')
-	elif _RE_INT.match(base_type):
-		return ('int', to_val, '2')
-	elif _RE_BIT.match(base_type):
-		return ('int', to_bit_val, '2')
-	elif _RE_DBL.match(base_type):
-		return ('double', to_val, '3')
-	elif _RE_BIN.match(base_type):
-		return ('int[]', to_bin_val, '4[2]')
-	elif _RE_SET.match(base_type):
-		return ('java.lang.String[]', to_set_val, '5[1]')
-	elif _RE_TIME.match(base_type):
-		return ('java.lang.String', to_str_val, '6')
-	elif _RE_DATE.match(base_type):
-		return ('java.lang.String', to_str_val, '7')
-	else:
+	base_type = base_type.strip().lower()
+	sindex = base_type.find(' ')
+	return base_type if sindex == -1 else base_type[:sindex]
+
+def ftype_to_type_code(ftype):
+	"""Returns the type code (index into _TYPE_REPS) for a column type."""
+	try:
+		return _ftype_codes[ftype]
+	except KeyError:
+		pass
+	base_type = normalize_base_type(ftype)
+	tcode = _BASE_TYPE_CODES.get(base_type)
+	if tcode is None:
 		print >>sys.stderr, "Warn: Unhandled base type:", base_type
-		return ('java.lang.String', to_str_val, '1')
-	
+		tcode = TC_STR
+	_ftype_codes[ftype] = tcode
+	return tcode
+
+def ftype_to_rep_val_comp(ftype):
+	return _TYPE_REPS[ftype_to_type_code(ftype)]
 
 def get_table_fields(conn, save_to=None):
 	tables = get_table_names(conn)
@@ -226,17 +328,94 @@ def get_table_fields(conn, save_to=None):
 				fname, ftype, nullable, keytype = row[:4]
 				nullable = nullable in ('YES', 'yes')
 				f = Field(fname, ftype, table=table, is_pkey=keytype=='PRI', nullable=nullable)
-				if _verbose: print repr(f)
+				if _verbose: print >>sys.stderr, repr(f)
 				tfields.append(f)
 			fields[table] = tfields
 	finally:
 		cur.close()
 
 	if save_to is not None:
-		with open(save_to, mode='wb') as outfile:
-			pickle.dump(fields, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+		write_fields(fields, save_to)
 	return fields
 
+# compact field serialization: a header followed by one columnar block per table
+_FIELDS_MAGIC = 'DDIF'
+_FIELDS_VERSION = 1
+_FIELDS_HEADER = struct.Struct('<4sHI')	# magic, version, table count
+_TABLE_HEADER = struct.Struct('<II')	# field count, string block length
+_FLAG_NULLABLE = 1
+_FLAG_PKEY = 2
+
+def write_fields(all_fields, outpath):
+	"""Writes fields in the compact binary format read by read_fields.
+	
+	Each table is stored as parallel arrays of names, types and flags, 
+	converters are rebound from the type code when read back.
+	"""
+	with open(outpath, 'wb') as out:
+		out.write(_FIELDS_HEADER.pack(_FIELDS_MAGIC, _FIELDS_VERSION, len(all_fields)))
+		for table, fields in all_fields.iteritems():
+			strings = [table]
+			strings.extend( f.name for f in fields )
+			strings.extend( f.ftype for f in fields )
+			strings.extend( f.rtype for f in fields )
+			strings = '\0'.join(strings)
+			codes = array('B', ( f.tcode for f in fields ))
+			flags = array('B', ( (_FLAG_NULLABLE if f.nullable else 0) | (_FLAG_PKEY if f.is_pkey else 0) for f in fields ))
+			out.write(_TABLE_HEADER.pack(len(fields), len(strings)))
+			out.write(strings)
+			out.write(codes.tostring())
+			out.write(flags.tostring())
+
+def _read_exact(infile, size):
+	data = infile.read(size)
+	if len(data) != size:
+		raise ValueError("Truncated fields file: %s" % infile.name)
+	return data
+
+def read_fields(inpath):
+	"""Reads fields saved by write_fields, or pickled by older versions.
+	
+	@rtype: dict
+	@return: a dict of table name -> list of Field
+	"""
+	with open(inpath, 'rb') as infile:
+		header = infile.read(_FIELDS_HEADER.size)
+		if len(header) != _FIELDS_HEADER.size or header[:4] != _FIELDS_MAGIC:
+			infile.seek(0)
+			return pickle.load(infile)
+		magic, version, ntables = _FIELDS_HEADER.unpack(header)
+		if version > _FIELDS_VERSION:
+			raise ValueError("Unsupported fields format version %d: %s" % (version, inpath))
+		
+		fields = {}
+		for _ in xrange(ntables):
+			nfields, strlen = _TABLE_HEADER.unpack(_read_exact(infile, _TABLE_HEADER.size))
+			strings = _read_exact(infile, strlen).split('\0')
+			codes = array('B', _read_exact(infile, nfields))
+			flags = array('B', _read_exact(infile, nfields))
+			if len(strings) != 1 + 3 * nfields:
+				raise ValueError("Corrupt fields file: %s" % inpath)
+			table = strings[0]
+			names = strings[1:1+nfields]
+			ftypes = strings[1+nfields:1+2*nfields]
+			rtypes = strings[1+2*nfields:]
+			tfields = []
+			for i in xrange(nfields):
+				tcode = codes[i]
+				is_pkey = bool(flags[i] & _FLAG_PKEY)
+				if tcode >= _BUILTIN_TYPE_CODES:
+					# custom codes follow registration order, which may differ in this process
+					tcode = ftype_to_type_code(ftypes[i])
+					rtype = _TYPE_REPS[tcode][0]
+					if rtypes[i] != rtype and not (is_pkey and rtypes[i] == 'hashcode'):
+						raise ValueError("Type %r of %s.%s is saved as %r but registered as %r in fields file: %s" % (
+							ftypes[i], table, names[i], rtypes[i], rtype, inpath))
+				tfields.append(Field(names[i], ftypes[i], rtype=rtypes[i], table=table, 
+					is_pkey=is_pkey, nullable=bool(flags[i] & _FLAG_NULLABLE), tcode=tcode))
+			fields[table] = tfields
+		return fields
+
 def write_old_decls(all_fields, outpath):
 	"""Writes declarations out in the old Daikon format."""
 	with open(outpath, 'w') as out:
@@ -249,54 +428,397 @@ def write_old_decls(all_fields, outpath):
 			out.write('\n')
 
 def write_old_trace(conn, all_fields, outpath, use_gzip=True, compress=_DEFAULT_COMPRESS, append=False, tables=None):
-	"""Writes a data trace of the current database state"""
-	if not use_gzip:
-		out = open(outpath, 'a' if append else 'w')
-	else:
-		if not outpath.endswith('.gz'): 
-			outpath += '.gz'
-		out = GzipFile(outpath, 'ab' if append else 'wb', compress)
-		
+	"""Writes a data trace of the current database state.
+	
+	Trace records are the same for both declaration formats.
+	
+	@param outpath: the trace path or an open TraceSink
+	"""
 	if tables is not None and not isinstance(tables, set):
 		tables = set(tables)
 	
 	# write the trace file
-	with out:
-		# build string pieces in a buffer to write once per db row
-		# saves a lot of time, especially with gzip on
-		buf = []
-		write = buf.append
-		def mwrite(*args): buf.extend(args)
-		
+	with trace_output(outpath, use_gzip=use_gzip, compress=compress, append=append) as out:
 		cur = conn.cursor()
 		try:
 			for table, fields in all_fields.iteritems():
 				if tables and table not in tables: 
 					continue
 
-				tbl_point = '\n%s:::POINT\n' % table
 				q = 'SELECT ' + ', '.join( f.fullname(quoted=True) for f in fields ) + \
 					' FROM `' + table + '`'
 				try:
 					cur.execute(q)
-					for row in cur:
-						write(tbl_point)
-						for i, field in enumerate(fields):
-							val = row[i]
-							if field.nullable:
-								write(field.null_trace_v1(val))
-								write('\n')
-							fval = str(field.to_val(val))
-							fmod = '1' if fval != 'nonsensical' else '2' 
-							mwrite(field.fullname(escaped=True), '\n', fval, '\n', fmod, '\n')
-						out.write(''.join(buf))
-						del buf[:]
+					write_table_records(out, table, fields, cur)
 				except MySQLdb.Error, e:
 					print >>sys.stderr, "Error %d: %s\nQuery: %s" % (e.args[0], e.args[1], q)
 					raise
 		finally:
 			cur.close()
 
+def trace_file_path(outpath, use_gzip=True):
+	"""Returns the trace file path, with '.gz' added if compressed."""
+	if use_gzip and not outpath.endswith('.gz'):
+		return outpath + '.gz'
+	return outpath
+
+def open_trace(outpath, use_gzip=True, compress=_DEFAULT_COMPRESS, append=False):
+	"""Opens a trace file for writing, adding '.gz' to the path if compressed."""
+	outpath = trace_file_path(outpath, use_gzip)
+	if not use_gzip:
+		return open(outpath, 'a' if append else 'w')
+	return GzipFile(outpath, 'ab' if append else 'wb', compress)
+
+class TraceLock(object):
+	"""Exclusive lock on a trace file for writers and compaction.
+	
+	The lock is taken on a separate '<trace>.lock' file, left next to the
+	trace, so it stays valid when compaction replaces the trace. The lock
+	file also keeps the trace's gzip member count for the compaction 
+	policy. Locking is skipped without fcntl.
+	"""
+	def __init__(self, path):
+		self.path = path + '.lock'
+		self._handle = None
+	def __enter__(self):
+		self._handle = open(self.path, 'a+')
+		if fcntl is not None:
+			fcntl.flock(self._handle.fileno(), fcntl.LOCK_EX)
+		return self
+	def __exit__(self, *args):
+		try:
+			if fcntl is not None:
+				fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+		finally:
+			self._handle.close()
+			self._handle = None
+	def read_members(self):
+		"""Returns the recorded gzip member count, None if unknown."""
+		self._handle.seek(0)
+		count = self._handle.read().strip()
+		return int(count) if count.isdigit() else None
+	def write_members(self, count):
+		"""Records the gzip member count, None to forget it."""
+		self._handle.seek(0)
+		self._handle.truncate()
+		if count is not None:
+			self._handle.write('%d\n' % count)
+		self._handle.flush()
+
+_CHUNK_SIZE = 1 << 20
+
+def count_gzip_members(path):
+	"""Counts the gzip members in a file by streaming through it."""
+	count = 0
+	with open(path, 'rb') as infile:
+		decomp = None
+		data = ''
+		while True:
+			if not data:
+				data = infile.read(_CHUNK_SIZE)
+				if not data: 
+					break
+			if decomp is None:
+				decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+				count += 1
+			decomp.decompress(data, _CHUNK_SIZE)
+			if decomp.unused_data:
+				# member ended, the rest starts the next one
+				data = decomp.unused_data
+				decomp = None
+			else:
+				data = decomp.unconsumed_tail
+	return count
+
+def _compact_trace(path, compress):
+	dirname, basename = os.path.split(path)
+	fd, tmp_path = tempfile.mkstemp(prefix=basename + '.', suffix='.tmp', dir=dirname or '.')
+	try:
+		with os.fdopen(fd, 'wb') as tmpfile:
+			with GzipFile(path, 'rb') as infile:
+				with GzipFile(path, 'wb', compress, tmpfile) as out:
+					data = infile.read(_CHUNK_SIZE)
+					while data:
+						out.write(data)
+						data = infile.read(_CHUNK_SIZE)
+			tmpfile.flush()
+			os.fsync(tmpfile.fileno())
+		os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+		os.rename(tmp_path, path)
+	except:
+		os.remove(tmp_path)
+		raise
+
+def compact_trace(path, compress=_DEFAULT_COMPRESS):
+	"""Rewrites a gzipped trace as a single gzip member.
+	
+	The trace is streamed into a temp file next to it which then 
+	replaces it, all while holding the trace lock.
+	"""
+	if not os.path.isfile(path):
+		raise IOError(errno.ENOENT, "No such trace", path)
+	with TraceLock(path) as lock:
+		_compact_trace(path, compress)
+		lock.write_members(1)
+
+def compact_trace_if_needed(path, max_members, compress=_DEFAULT_COMPRESS):
+	"""Compacts a gzipped trace if it has more than max_members members.
+	
+	The member count kept by trace writers is used, the trace is only 
+	scanned with count_gzip_members if that count is missing.
+	
+	@return: True if the trace was compacted
+	"""
+	if not os.path.isfile(path):
+		return False
+	with TraceLock(path) as lock:
+		count = lock.read_members()
+		if count is None:
+			count = count_gzip_members(path)
+			lock.write_members(count)
+		if count <= max_members:
+			return False
+		_compact_trace(path, compress)
+		lock.write_members(1)
+		return True
+
+@contextlib.contextmanager
+def trace_output(outpath, use_gzip=True, compress=_DEFAULT_COMPRESS, append=False):
+	"""Yields the output to write a trace to.
+	
+	An open TraceSink is used as is and left open for the caller, a path
+	is opened (see open_trace) while holding its trace lock, which creates
+	a '<trace>.lock' file next to it (see TraceLock).
+	"""
+	if isinstance(outpath, TraceSink):
+		yield outpath
+		return
+	path = trace_file_path(outpath, use_gzip)
+	with TraceLock(path) as lock:
+		appending = append and os.path.isfile(path)
+		try:
+			with open_trace(outpath, use_gzip=use_gzip, compress=compress, append=append) as out:
+				yield out
+		except:
+			# a partial member may have been written
+			lock.write_members(None)
+			raise
+		if use_gzip:
+			# every write adds one gzip member
+			count = lock.read_members() if appending else 0
+			lock.write_members(None if count is None else count + 1)
+
+# a consumer that kept up made writes block for at most this share of the 
+# time, shorter stalls (in seconds) are ignored as noise
+_SINK_MAX_BLOCKED = 0.25
+_SINK_MIN_STALL = 0.1
+# longest total wait (in seconds) at close for a socket consumer to take 
+# the data still queued, and how often to check
+_SINK_DRAIN_TIMEOUT = 5
+_SINK_DRAIN_POLL = 0.01
+# errors of a consumer going away
+_CONSUMER_GONE = (errno.EPIPE, errno.ECONNRESET)
+
+def _consumer_gone(name):
+	return IOError(errno.EPIPE, "Trace consumer closed " + name)
+
+class _TimedWriter(object):
+	"""Writes to a stream, recording how long writes block."""
+	def __init__(self, name, raw):
+		self.name = name
+		self.raw = raw
+		self.bytes_written = 0
+		self.blocked_time = 0.0
+	def write(self, data):
+		if not data: 
+			return
+		start = time.time()
+		try:
+			self.raw.write(data)
+			self.raw.flush()
+		except (IOError, socket.error), e:
+			if e.errno in _CONSUMER_GONE:
+				raise _consumer_gone(self.name)
+			raise
+		self.blocked_time += time.time() - start
+		self.bytes_written += len(data)
+	def flush(self):
+		pass
+
+class TraceSink(object):
+	"""Streams a trace to a consumer, like Daikon reading a pipe or socket.
+	
+	Writes block while the consumer is behind, which slows tracing down
+	to its pace. The time spent blocked is recorded to tell if it kept up.
+	Lag hidden in kernel buffers at the end is only seen if the closer 
+	returns how long the consumer took to drain them (sockets do, where
+	supported). Otherwise drain_measured stays False and the blocked time
+	is a lower bound.
+	"""
+	def __init__(self, name, raw, use_gzip=True, compress=_DEFAULT_COMPRESS, closer=None):
+		self.name = name
+		self._timed = _TimedWriter(name, raw)
+		self._closer = closer
+		self.drain_measured = False
+		self._out = GzipFile('', 'wb', compress, self._timed) if use_gzip else self._timed
+		self._start = time.time()
+		self.elapsed = None
+	def __enter__(self):
+		return self
+	def __exit__(self, *args):
+		self.close()
+	def write(self, data):
+		self._out.write(data)
+	def close(self):
+		if self.elapsed is not None:
+			return
+		try:
+			if self._out is not self._timed:
+				self._out.close()
+		except:
+			exc_info = sys.exc_info()
+			self.elapsed = time.time() - self._start
+			if self._closer:
+				try:
+					self._closer()
+				except Exception:
+					pass # report the first error
+			raise exc_info[0], exc_info[1], exc_info[2]
+		self.elapsed = time.time() - self._start
+		if self._closer:
+			start = time.time()
+			try:
+				drain_time = self._closer()
+			finally:
+				self.elapsed += time.time() - start
+			if drain_time is not None:
+				self._timed.blocked_time += drain_time
+				self.drain_measured = True
+	@property
+	def bytes_written(self):
+		return self._timed.bytes_written
+	@property
+	def blocked_time(self):
+		return self._timed.blocked_time
+	@property
+	def kept_up(self):
+		"""If the consumer read the trace about as fast as it was written."""
+		elapsed = self.elapsed if self.elapsed is not None else time.time() - self._start
+		return self.blocked_time <= max(_SINK_MAX_BLOCKED * elapsed, _SINK_MIN_STALL)
+	def summary(self):
+		elapsed = self.elapsed if self.elapsed is not None else time.time() - self._start
+		return "Streamed %d bytes to %s in %.1fs, %s%.1fs blocked on the consumer%s" % (
+			self.bytes_written, self.name, elapsed, '' if self.drain_measured else 'at least ', 
+			self.blocked_time, '' if self.kept_up else " (consumer did not keep up)")
+
+def open_sink(spec, use_gzip=True, compress=_DEFAULT_COMPRESS):
+	"""Opens a trace sink from its spec.
+	
+	@param spec: '-' for stdout, 'fifo:PATH' for a named pipe (created if
+		missing), 'tcp:HOST:PORT' or 'unix:PATH' to connect to a listening socket
+	@rtype: TraceSink
+	"""
+	if spec == '-':
+		return TraceSink('stdout', sys.stdout, use_gzip, compress)
+	kind, sep, target = spec.partition(':')
+	if not sep or not target:
+		raise ValueError("Invalid sink: %s" % spec)
+	if kind == 'fifo':
+		if not os.path.exists(target):
+			os.mkfifo(target)
+		elif not stat.S_ISFIFO(os.stat(target).st_mode):
+			raise ValueError("FIFO sink exists but is not a FIFO: %s" % target)
+		# blocks until a consumer opens the other end
+		raw = open(target, 'wb')
+		return TraceSink(spec, raw, use_gzip, compress, closer=raw.close)
+	if kind == 'tcp':
+		host, sep, port = target.rpartition(':')
+		if not sep or not port.isdigit():
+			raise ValueError("Invalid TCP sink, need tcp:HOST:PORT: %s" % spec)
+		sock = socket.create_connection((host or 'localhost', int(port)))
+	elif kind == 'unix':
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.connect(target)
+	else:
+		raise ValueError("Unknown sink type '%s': %s" % (kind, spec))
+	raw = sock.makefile('wb', 0)
+	def closer():
+		# returns how long the consumer took to take the queued data, None if unknown
+		try:
+			raw.close()
+			start = time.time()
+			deadline = start + _SINK_DRAIN_TIMEOUT
+			unsent = _unsent_bytes(sock)
+			while unsent and time.time() < deadline:
+				time.sleep(_SINK_DRAIN_POLL)
+				unsent = _unsent_bytes(sock)
+			drain_time = time.time() - start if unsent == 0 else None
+			sock.shutdown(socket.SHUT_WR)
+			return drain_time
+		except socket.error, e:
+			if e.errno in _CONSUMER_GONE:
+				raise _consumer_gone(spec)
+			raise
+		finally:
+			sock.close()
+	return TraceSink(spec, raw, use_gzip, compress, closer=closer)
+
+def _unsent_bytes(sock):
+	"""Returns the bytes queued on a socket that the consumer has not 
+	taken yet (for TCP, not yet acknowledged), None if unknown."""
+	if fcntl is None or _SIOCOUTQ is None:
+		return None
+	try:
+		return struct.unpack('i', fcntl.ioctl(sock.fileno(), _SIOCOUTQ, struct.pack('i', 0)))[0]
+	except IOError:
+		return None
+
+def trace_record_template(table, fields):
+	"""Returns a %-format template for one trace record of a table.
+	
+	Variable names are rendered once, each field leaves slots for its
+	null indicator (if nullable), its value and its modified bit.
+	"""
+	parts = ['\n', table.replace('%', '%%'), ':::POINT\n']
+	for field in fields:
+		if field.nullable:
+			parts.extend((field._nullable_name().replace('%', '%%'), '\n%s\n1\n'))
+		parts.extend((field.fullname(escaped=True).replace('%', '%%'), '\n%s\n%s\n'))
+	return ''.join(parts)
+
+# value of a nullable field's __IS_NULL__ hashcode variable when the field
+# is not null, Daikon only tells it apart from 'null' so any constant works
+_NONNULL_VAL = str(id(''))
+_TRACE_BATCH_ROWS = 256
+
+def write_table_records(out, table, fields, rows):
+	"""Writes a trace record for each row using the table's template.
+	
+	@param out: the open trace file
+	@param rows: an iterable of value sequences in the order of fields
+	"""
+	template = trace_record_template(table, fields)
+	slots = [ (field.to_val, field.nullable) for field in fields ]
+	# format records into a buffer and write in batches
+	# saves a lot of time, especially with gzip on
+	buf = []
+	vals = []
+	add = vals.append
+	for row in rows:
+		for (conv, nullable), val in izip(slots, row):
+			if nullable:
+				add('null' if val is None else _NONNULL_VAL)
+			fval = str(conv(val))
+			add(fval)
+			add('1' if fval != 'nonsensical' else '2')
+		buf.append(template % tuple(vals))
+		del vals[:]
+		if len(buf) >= _TRACE_BATCH_ROWS:
+			out.write(''.join(buf))
+			del buf[:]
+	if buf:
+		out.write(''.join(buf))
+
 def write_decls_v2(all_fields, outpath):
 	"""Writes declarations out in the version 2 Daikon format."""
 	with open(outpath, 'w') as out:
@@ -314,10 +836,11 @@ def write_decls_v2(all_fields, outpath):
 def main(args=None):
 	if args is None: args = sys.argv[1:]
 	try:
-		opts, args = getopt.gnu_getopt(args, "hH:u:p:P:d:o:V:vc:f:O:at:",
+		opts, args = getopt.gnu_getopt(args, "hH:u:p:P:d:o:V:vc:f:O:at:m:s:",
 			("help", "host=", "user=", "password=", "port=", "database=", 
 			 "output=", "version=", "verbose", "no-gzip", "compress-level=", 
-			 "fields-file=", "operation=", "append", "tables="))
+			 "fields-file=", "operation=", "append", "tables=", "compact-members=", 
+			 "sink="))
 	except getopt.GetoptError, err:
 		print >>sys.stderr, str(err)
 		return 1
@@ -329,6 +852,8 @@ def main(args=None):
 	use_gzip = True
 	append = False
 	tables = None
+	compact_members = DEFAULT_COMPACT_MEMBERS
+	sink = None
 	compress_level = _DEFAULT_COMPRESS
 	operation = set(('decls', 'dtrace'))
 	
@@ -365,6 +890,10 @@ def main(args=None):
 			append = True
 		elif o in ('t', 'tables'):
 			tables = set(a.split(','))
+		elif o in ('m', 'compact-members'):
+			compact_members = a
+		elif o in ('s', 'sink'):
+			sink = a
 			
 	# check options
 	if not output:
@@ -382,6 +911,13 @@ def main(args=None):
 	except ValueError:
 		print >>sys.stderr, "Invalid compression level:", compress_level
 		return 1
+	try:
+		compact_members = int(compact_members)
+		if compact_members < 0:
+			raise ValueError
+	except ValueError:
+		print >>sys.stderr, "Invalid compact member count:", compact_members
+		return 1
 	if 'user' not in cargs:
 		cargs['user'] = output
 	if 'db' not in cargs:
@@ -393,9 +929,20 @@ def main(args=None):
 	global _verbose
 	_verbose = verbose
 	if verbose:
-		print "Tracing '" + output + "' with version", version, "and args:\n" + repr(cargs)
-	convert(output, decls_version=int(version), decls='decls' in operation, dtrace='dtrace' in operation, \
-			use_gzip=use_gzip, compress=compress_level, append=append, tables=tables, **cargs)
+		print >>sys.stderr, "Tracing '" + output + "' with version", version, "and args:\n" + repr(cargs)
+	if 'decls' in operation or 'dtrace' in operation:
+		convert(output, decls_version=int(version), decls='decls' in operation, dtrace='dtrace' in operation, \
+				use_gzip=use_gzip, compress=compress_level, append=append, tables=tables, \
+				compact_members=compact_members, sink=sink, **cargs)
+	if 'compact' in operation:
+		if not use_gzip:
+			print >>sys.stderr, "Can only compact gzipped traces."
+			return 1
+		trace_path = trace_file_path(output + '.dtrace')
+		if not os.path.isfile(trace_path):
+			print >>sys.stderr, "No trace to compact:", trace_path
+			return 1
+		compact_trace(trace_path, compress_level)
 	return 0
 
 if __name__ == '__main__':